@@ -1,5 +1,9 @@
+from array import array
+import concurrent.futures
 import csv
+import functools
 import itertools
+import os
 import sys
 
 PROBS = {
@@ -36,6 +40,35 @@ PROBS = {
     "mutation": 0.01
 }
 
+# PROBS["gene"] and PROBS["trait"] as tuples indexed by number of copies (and by
+# has trait, 0 or 1), for the enumeration loop in enumerate_probabilities
+GENE_PROBS = tuple(PROBS["gene"][num_copies] for num_copies in range(3))
+TRAIT_PROBS = tuple(
+    (PROBS["trait"][num_copies][False], PROBS["trait"][num_copies][True])
+    for num_copies in range(3)
+)
+
+# Probability that a parent with 0, 1 or 2 copies of the gene passes one on to a child
+TRANSMIT = (PROBS["mutation"], 0.5 * 0.99, 0.99)
+
+# P_CHILD[father_copies][mother_copies][child_copies]: probability that a child has
+# child_copies copies of the gene, given the number of copies of their parents
+P_CHILD = tuple(
+    tuple(
+        (
+            (1 - TRANSMIT[father_copies]) * (1 - TRANSMIT[mother_copies]),
+            TRANSMIT[father_copies] * (1 - TRANSMIT[mother_copies])
+            + TRANSMIT[mother_copies] * (1 - TRANSMIT[father_copies]),
+            TRANSMIT[father_copies] * TRANSMIT[mother_copies]
+        )
+        for mother_copies in range(3)
+    )
+    for father_copies in range(3)
+)
+
+# Below this many people, starting worker processes costs more than it saves
+PARALLEL_MIN_PEOPLE = 10
+
 
 def main():
 
@@ -44,54 +77,41 @@ def main():
         sys.exit("Usage: python heredity.py data.csv")
     people = load_data(sys.argv[1])
 
-    # Keep track of gene and trait probabilities for each person
-    probabilities = {
-        person: {
-            "gene": {
-                2: 0,
-                1: 0,
-                0: 0
-            },
-            "trait": {
-                True: 0,
-                False: 0
-            }
-        }
-        for person in people
-    }
-
-    # Loop over all sets of people who might have the trait
-    names = set(people)
-    for have_trait in powerset(names):
-
-        # Check if current set of people violates known information
-        fails_evidence = any(
-            (people[person]["trait"] is not None and
-             people[person]["trait"] != (person in have_trait))
-            for person in names
-        )
-        if fails_evidence:
-            continue
-
-        # Loop over all sets of people who might have the gene
-        for one_gene in powerset(names):
-            for two_genes in powerset(names - one_gene):
-
-                # Update probabilities with new joint probability
-                p = joint_probability(people, one_gene, two_genes, have_trait)
-                update(probabilities, one_gene, two_genes, have_trait, p)
+    names, father_idx, mother_idx = index_people(people)
+
+    # Bitmasks (bit i for person i) of the people whose trait is known,
+    # and of the people known to have the trait
+    known_trait_mask = 0
+    required_trait_mask = 0
+    for i, name in enumerate(names):
+        if people[name]["trait"] is not None:
+            known_trait_mask |= 1 << i
+            if people[name]["trait"]:
+                required_trait_mask |= 1 << i
+
+    # Add up the joint probability of every assignment of genes and traits
+    if len(names) >= PARALLEL_MIN_PEOPLE and (os.cpu_count() or 1) > 1:
+        enumerate_fn = enumerate_probabilities_parallel
+    else:
+        enumerate_fn = enumerate_probabilities
+    gene_acc, trait_acc = enumerate_fn(
+        father_idx, mother_idx, known_trait_mask, required_trait_mask
+    )
 
     # Ensure probabilities sum to 1
-    normalize(probabilities)
+    normalize_accumulators(gene_acc, trait_acc)
 
     # Print results
+    index = {name: i for i, name in enumerate(names)}
     for person in people:
+        i = index[person]
         print(f"{person}:")
-        for field in probabilities[person]:
-            print(f"  {field.capitalize()}:")
-            for value in probabilities[person][field]:
-                p = probabilities[person][field][value]
-                print(f"    {value}: {p:.4f}")
+        print("  Gene:")
+        for num_copies in (2, 1, 0):
+            print(f"    {num_copies}: {gene_acc[3 * i + num_copies]:.4f}")
+        print("  Trait:")
+        for has_trait in (True, False):
+            print(f"    {has_trait}: {trait_acc[2 * i + has_trait]:.4f}")
 
 
 def load_data(filename):
@@ -116,16 +136,32 @@ def load_data(filename):
     return data
 
 
-def powerset(s):
+def index_people(people):
     """
-    Return a list of all possible subsets of set s.
+    Assign every person an integer index, in topological order (parents get a
+    lower index than their children).
+    Return the list of names in index order, along with lists `father_idx`
+    and `mother_idx` holding the index of each person's parents
+    (-1 if the parent is unknown).
     """
-    s = list(s)
-    return [
-        set(s) for s in itertools.chain.from_iterable(
-            itertools.combinations(s, r) for r in range(len(s) + 1)
-        )
-    ]
+    names = []
+    placed = set()
+
+    def place(name):
+        if name is None or name in placed:
+            return
+        place(people[name]["father"])
+        place(people[name]["mother"])
+        placed.add(name)
+        names.append(name)
+
+    for name in people:
+        place(name)
+
+    index = {name: i for i, name in enumerate(names)}
+    father_idx = [index.get(people[name]["father"], -1) for name in names]
+    mother_idx = [index.get(people[name]["mother"], -1) for name in names]
+    return names, father_idx, mother_idx
 
 
 def joint_probability(people, one_gene, two_genes, have_trait):
@@ -139,75 +175,67 @@ def joint_probability(people, one_gene, two_genes, have_trait):
         * everyone in set `have_trait` has the trait, and
         * everyone not in set` have_trait` does not have the trait.
     """
-    zero_gene = set([name for name in people if name not in one_gene and name not in two_genes])
-    one_gene_p = {} # key: value --> name: probability of having one copy of the gene
-    two_genes_p = {} # key: value --> name: probability of having two copies of the gene
-    zero_gene_p = {}
-    
-    # Computing the probability of person having one copy of the gene.
-    for name in one_gene:
-        # A person has one copy of the gene either from the mother AND NOT the father, 
-        # or from the father AND NOT the mother. In case we have no info about parents, use
-        # unconditional probability.
-        father, mother = people[name]["father"], people[name]["mother"]
-        if father == None or mother == None: # TODO: and should give the same result 
-                                             # as or per the problem description
-            one_gene_p[name] = PROBS["gene"][1]
-            continue
-        
-        poppa_p, momma_p = person_prob(father, one_gene, two_genes), person_prob(mother, one_gene, two_genes)
-        one_gene_p[name] = poppa_p * (1 - momma_p)  +  momma_p * (1 - poppa_p)
-        
-
-    # Computing the probability of person having two copies of the gene.
-    for name in two_genes:
-        # A person has two copies of the gene, one from BOTH parents.
-        # Note, the parents may have no copies but the copy is mutated.
-        father, mother = people[name]["father"], people[name]["mother"]
-        if father == None or mother == None: # TODO: and should give the same result 
-                                             # as or per the problem description
-            two_genes_p[name] = PROBS["gene"][2]
-            continue
-        poppa_p, momma_p = person_prob(father, one_gene, two_genes), person_prob(mother, one_gene, two_genes)
-        two_genes_p[name] = poppa_p * momma_p
-
-    # Computing the probability of person having zero copies of the gene.
-    for name in zero_gene:
-        # A person has zero copy of the gene if BOTH parents gave zero copies.
-        # This can happen if parent has zero copy of gene, or via mutation.
-        father, mother = people[name]["father"], people[name]["mother"]
-        if father == None or mother == None: # TODO: and should give the same result 
+    return trait_joint(gene_joint(people, one_gene, two_genes), have_trait)
+
+def gene_joint(people, one_gene, two_genes):
+    """
+    Helper function for joint probability.
+    Returns the dictionaries (zero_gene_p, one_gene_p, two_genes_p) of the form
+    name:probability, with the probability that each person has the number of copies
+    of the gene given by `one_gene` and `two_genes`, knowing how many their parents have.
+    These don't depend on the trait, so callers looping over many `have_trait` sets for
+    the same genes can compute them once and pass them to trait_joint.
+    """
+    # Number of copies of the gene of each person
+    gene_count_of = {
+        name: 2 if name in two_genes else 1 if name in one_gene else 0
+        for name in people
+    }
+
+    # key: value --> name: probability of having zero, one or two copies of the gene,
+    # indexed by the number of copies
+    prob_dicts = ({}, {}, {})
+
+    for name, person in people.items():
+        num_copies = gene_count_of[name]
+        father, mother = person["father"], person["mother"]
+        if father == None or mother == None: # TODO: and should give the same result
                                              # as or per the problem description
-            zero_gene_p[name] = PROBS["gene"][0]
+            # In case we have no info about parents, use unconditional probability.
+            prob_dicts[num_copies][name] = PROBS["gene"][num_copies]
             continue
-        poppa_p, momma_p = person_prob(father, one_gene, two_genes), person_prob(mother, one_gene, two_genes)
-        zero_gene_p[name] = (1-poppa_p) * (1 - momma_p)
 
-    # Computing the join probability of all the events. 
-    joint_p = 1
-    for index, prob_dict in enumerate([zero_gene_p, one_gene_p, two_genes_p]): # !Important: Must be in this order!
-        joint_p *= trait_prob(prob_dict, index, have_trait)
+        # Probability that each parent passes a copy of the gene to this person
+        poppa_p, momma_p = TRANSMIT[gene_count_of[father]], TRANSMIT[gene_count_of[mother]]
+        not_poppa_p, not_momma_p = 1 - poppa_p, 1 - momma_p
+        child_probs = (
+            # A person has zero copy of the gene if BOTH parents gave zero copies.
+            # This can happen if parent has zero copy of gene, or via mutation.
+            not_poppa_p * not_momma_p,
+            # A person has one copy of the gene either from the mother AND NOT the father,
+            # or from the father AND NOT the mother.
+            poppa_p * not_momma_p + momma_p * not_poppa_p,
+            # A person has two copies of the gene, one from BOTH parents.
+            # Note, the parents may have no copies but the copy is mutated.
+            poppa_p * momma_p
+        )
+        prob_dicts[num_copies][name] = child_probs[num_copies]
 
-    return joint_p
+    return prob_dicts
 
-def person_prob(person_name, one_gene_names, two_genes_names):
+def trait_joint(gene_probs_by_count, have_trait):
     """
     Helper function for joint probability.
-    It takes person_name (father or mother), and the context (one_gene people and two gene)
-    and returns the probability that one copy is gotten from person_name if gives_copy == True else
-    returns that no copy is gotten from person_name
+    Takes the dictionaries returned by gene_joint and have_trait, and returns the
+    joint probability of the gene and trait events.
     """
-   
-    if person_name in two_genes_names:
-        # gives_copy == True: Probability that the name in the iterator in the function above this one
-        # gets a copy from person_name, given that the person_name has two copies 
-        person_p = 0.99 
-                        
-    elif person_name in one_gene_names:
-        person_p = 0.5 * 0.99 
-    else: 
-        person_p = PROBS["mutation"]
-    return person_p
+    joint_p = 1
+    for index, prob_dict in enumerate(gene_probs_by_count): # !Important: Must be in order zero, one, two!
+        joint_p *= trait_prob(prob_dict, index, have_trait)
+        if joint_p == 0: # No need to multiply the remaining factors
+            return 0.0
+
+    return joint_p
 
 def trait_prob(prob_dict, num_copies, have_trait):
     """
@@ -218,13 +246,187 @@ def trait_prob(prob_dict, num_copies, have_trait):
     E.g one_gene_p is a dictionary with names and the probability they have 1 copy. So the function can be called this way:
     trait_prob(one_gene_p, 1, have_trait)
     """
+    # The trait factor is the same for everyone in prob_dict with (or without) the
+    # trait, so it is raised to the number of such people instead of multiplied in each time
     product_ = 1
-    for name in prob_dict:
+    num_with_trait = 0
+    for name, prob in prob_dict.items():
+        product_ *= prob
+        if product_ == 0:
+            return 0.0
         if name in have_trait:
-            product_ *= prob_dict[name] * PROBS['trait'][num_copies][True]
+            num_with_trait += 1
+    num_without_trait = len(prob_dict) - num_with_trait
+    return (product_ * PROBS['trait'][num_copies][True] ** num_with_trait
+            * PROBS['trait'][num_copies][False] ** num_without_trait)
+
+def enumerate_probabilities(father_idx, mother_idx, known_trait_mask, required_trait_mask,
+                            typecode="d", prefix=()):
+    """
+    Add up the joint probability of every assignment of genes and traits to the
+    people indexed as in father_idx and mother_idx that agrees with the known
+    traits, given as bitmasks (bit i for person i).
+    People must be indexed in topological order, as returned by index_people.
+    If prefix is given, only the assignments where the first people have
+    prefix[0], prefix[1], ... copies of the gene are added up.
+    Returns the flat arrays gene_acc and trait_acc, where gene_acc[3 * i + num_copies]
+    and trait_acc[2 * i + has_trait] (0 or 1) are the sums for person i, stored with
+    the given typecode: "d" for 64-bit floats, or "f" for 32-bit floats, which halves
+    their size but loses precision.
+    This is the hot loop of the program: it runs for each of the 3^N gene assignments,
+    so everything is inlined here and looked up through local lists and tuples.
+    """
+    n = len(father_idx)
+
+    # Sums are accumulated in Python floats (64 bits, and faster to add to than
+    # array items), then stored with the requested precision at the end
+    gene_acc = [[0.0] * 3 for _ in range(n)]
+    trait_acc = [[0.0] * 2 for _ in range(n)]
+
+    # People whose trait is known, with whether they have it (0 or 1),
+    # and people whose trait is unknown
+    known_traits = [
+        (i, required_trait_mask >> i & 1) for i in range(n) if known_trait_mask >> i & 1
+    ]
+    unknown_idx = [i for i in range(n) if not known_trait_mask >> i & 1]
+    unknown_trait_acc = [trait_acc[i] for i in unknown_idx]
+
+    # All sets of people who might have the trait that don't violate known
+    # information: everyone known to have the trait, plus any subset of the people
+    # whose trait is unknown. The subsets are enumerated directly as the submasks
+    # of unknown_mask, and each is stored as whether each person in unknown_idx
+    # has the trait (0 or 1).
+    unknown_mask = ((1 << n) - 1) ^ known_trait_mask
+    trait_states = []
+    sub_mask = unknown_mask
+    while True:
+        trait_states.append([sub_mask >> i & 1 for i in unknown_idx])
+        if sub_mask == 0:
+            break
+        sub_mask = (sub_mask - 1) & unknown_mask
+
+    @functools.lru_cache(maxsize=None)
+    def unknown_trait_sums(unknown_counts):
+        """
+        Takes the number of copies of each person whose trait is unknown (as in
+        unknown_idx), and returns the sum of P(their traits | genes) over all the trait
+        sets, along with, for each of these people, the sums over the sets where they
+        don't and do have the trait. This only depends on those people's copies, so it
+        is memoized: it is computed once for each of their 3^unknown combinations of
+        copies instead of once for every gene assignment.
+        """
+        unknown_trait_probs = [TRAIT_PROBS[num_copies] for num_copies in unknown_counts]
+        total_p = 0
+        person_sums = [[0.0, 0.0] for _ in unknown_counts]
+        for trait_state in trait_states:
+            p = 1
+            for trait_p, has_trait in zip(unknown_trait_probs, trait_state):
+                p *= trait_p[has_trait]
+
+            total_p += p
+            for sums, has_trait in zip(person_sums, trait_state):
+                sums[has_trait] += p
+        return total_p, person_sums
+
+    # For each person, the probabilities of having 0, 1 or 2 copies, unconditionally
+    # if their parents are unknown or else indexed by their parents' copies, as
+    # [father_copies][mother_copies], times the probability of their trait if it is
+    # known. Folding the known traits in here means they are multiplied into the
+    # running product once per prefix, instead of looped over at every assignment.
+    person_probs = []
+    for i in range(n):
+        trait_factors = (1, 1, 1)
+        if known_trait_mask >> i & 1:
+            has_trait = required_trait_mask >> i & 1
+            trait_factors = tuple(TRAIT_PROBS[num_copies][has_trait] for num_copies in range(3))
+
+        if father_idx[i] < 0 or mother_idx[i] < 0:
+            person_probs.append(tuple(p * f for p, f in zip(GENE_PROBS, trait_factors)))
+        else:
+            person_probs.append(tuple(
+                tuple(tuple(p * f for p, f in zip(probs, trait_factors)) for probs in row)
+                for row in P_CHILD
+            ))
+
+    # Number of copies of the gene of everyone assigned so far
+    gene_state = [0] * n
+
+    def assign(i, gene_p):
+        """
+        Assign 0, 1 or 2 copies to person i and everyone after them, where gene_p
+        is the probability of the copies assigned to everyone before them (and of
+        their traits, for those whose trait is known).
+        People are in topological order, so person i's parents are already assigned
+        and the product of everyone before them is shared by all their completions,
+        instead of being recomputed for each of the 3^N assignments.
+        """
+        if i == n:
+            # The joint probability is P(genes) * P(traits | genes). gene_p already
+            # includes the factors of the known traits, and the sums over the trait
+            # sets of the people whose trait is unknown are looked up.
+            total_p, person_sums = unknown_trait_sums(
+                tuple([gene_state[person] for person in unknown_idx])
+            )
+            total_p *= gene_p
+            for trait_row, sums in zip(unknown_trait_acc, person_sums):
+                trait_row[0] += gene_p * sums[0]
+                trait_row[1] += gene_p * sums[1]
+
+            # The gene assignment and the known traits are the same for every trait
+            # set, so their accumulators are updated once with the total
+            for gene_row, num_copies in zip(gene_acc, gene_state):
+                gene_row[num_copies] += total_p
+            for person, has_trait in known_traits:
+                trait_acc[person][has_trait] += total_p
+            return
+
+        father, mother = father_idx[i], mother_idx[i]
+        if father < 0 or mother < 0:
+            probs = person_probs[i]
         else:
-            product_ *= prob_dict[name] * PROBS['trait'][num_copies][False]  
-    return product_  
+            probs = person_probs[i][gene_state[father]][gene_state[mother]]
+
+        for num_copies in range(3) if i >= len(prefix) else (prefix[i],):
+            # Every assignment completing a zero probability prefix also has zero probability
+            person_gene_p = gene_p * probs[num_copies]
+            if person_gene_p == 0:
+                continue
+            gene_state[i] = num_copies
+            assign(i + 1, person_gene_p)
+
+    assign(0, 1)
+    return (
+        array(typecode, itertools.chain.from_iterable(gene_acc)),
+        array(typecode, itertools.chain.from_iterable(trait_acc))
+    )
+
+def enumerate_probabilities_parallel(father_idx, mother_idx, known_trait_mask,
+                                     required_trait_mask, typecode="d", max_workers=None):
+    """
+    Same as enumerate_probabilities, but split between max_workers processes
+    (by default, one per CPU). Each task adds up the assignments starting with one
+    combination of copies for the first few people, and the sums are added together.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+
+    # Fix the copies of enough of the first people to give every worker several tasks
+    prefix_len = 0
+    while 3 ** prefix_len < 4 * max_workers and prefix_len < len(father_idx):
+        prefix_len += 1
+    prefixes = itertools.product(range(3), repeat=prefix_len)
+
+    task = functools.partial(
+        enumerate_probabilities, father_idx, mother_idx,
+        known_trait_mask, required_trait_mask, typecode
+    )
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+        results = executor.map(task, prefixes)
+        gene_acc, trait_acc = next(results)
+        for task_gene_acc, task_trait_acc in results:
+            for acc, task_acc in ((gene_acc, task_gene_acc), (trait_acc, task_trait_acc)):
+                for j in range(len(acc)):
+                    acc[j] += task_acc[j]
+    return gene_acc, trait_acc
 
 def update(probabilities, one_gene, two_genes, have_trait, p):
     """
@@ -248,26 +450,27 @@ def update(probabilities, one_gene, two_genes, have_trait, p):
             probabilities[person]["gene"][0] += p
 
 
-def get_dist_sum(dist):
-    """
-    Takes a dictionary(dist) and returns the sum of its values
-    """
-    sum_ = 0
-    for item in dist:
-        sum_ += dist[item]
-    return sum_
-
 def normalize(probabilities):
     """
     Update `probabilities` such that each probability distribution
     is normalized (i.e., sums to 1, with relative proportions the same).
     """
     for person_name in probabilities:
-        for dist_name in probabilities[person_name]: # dist_name == distribution_name (e.g "gene")
-            sum_ = get_dist_sum(probabilities[person_name][dist_name])
-            for item in probabilities[person_name][dist_name]:
-                probabilities[person_name][dist_name][item] /= sum_
+        for dist in probabilities[person_name].values(): # e.g the "gene" distribution
+            sum_ = sum(dist.values())
+            for item in dist:
+                dist[item] /= sum_
 
+def normalize_accumulators(gene_acc, trait_acc):
+    """
+    Same as normalize, but for the flat gene_acc and trait_acc arrays
+    returned by enumerate_probabilities, updated in place.
+    """
+    for acc, dist_size in ((gene_acc, 3), (trait_acc, 2)):
+        for start in range(0, len(acc), dist_size):
+            sum_ = sum(acc[start:start + dist_size])
+            for j in range(start, start + dist_size):
+                acc[j] /= sum_
 
 
 if __name__ == "__main__":